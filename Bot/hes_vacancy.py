@@ -1,7 +1,9 @@
 import json
 import os
 import logging
-from typing import Dict, Any
+from typing import Dict, Any, Optional
+
+from seen_ids import SeenIds
 
 logger = logging.getLogger(__name__)
 handler = logging.FileHandler("hes_vacancy.log", 'a', encoding='utf-8')
@@ -14,10 +16,22 @@ logger.setLevel("INFO")
 
 
 class Hash_Vacancy:
+    _seen_ids: Optional[SeenIds] = None
+
     def __init__(self, items: Dict[str, Any]=None):
         self.items = items
         self.new_vacancies: Dict[str, Any] = {}
-        self.existing_data: Dict[str, Any] = self.load_existing_data()
+        self.seen_ids: SeenIds = self.get_seen_ids()
+
+    @classmethod
+    def get_seen_ids(cls) -> SeenIds:
+        """Индекс просмотренных id, общий для всех экземпляров"""
+        if cls._seen_ids is None:
+            cls._seen_ids = SeenIds(
+                "Vacancy.seen.npz",
+                bootstrap=lambda: cls.load_existing_data().keys(),
+            )
+        return cls._seen_ids
 
     @classmethod
     def load_existing_data(cls) -> Dict[str, Any]:
@@ -52,9 +66,8 @@ class Hash_Vacancy:
 
     def filter_new_vacancies(self):
         """Фильтрует вакансии, оставляя только новые"""
-        for vacancy_id, vacancy_data in self.items.items():
-            if vacancy_id not in self.existing_data:
-                self.new_vacancies[vacancy_id] = vacancy_data
+        for vacancy_id in self.seen_ids.filter_new(self.items):
+            self.new_vacancies[vacancy_id] = self.items[vacancy_id]
         return self.new_vacancies
 
 
@@ -63,8 +76,17 @@ class Hash_Vacancy:
         if not self.new_vacancies:
             return False
 
-        updated_data = {**self.existing_data, **self.new_vacancies}
+        # Файл читается только при записи и заодно очищается от устаревших записей
+        self.seen_ids.maybe_compact()
+        existing_data = {
+            vacancy_id: vacancy_data
+            for vacancy_id, vacancy_data in self.load_existing_data().items()
+            if not self.seen_ids.is_expired(vacancy_id)
+        }
+        updated_data = {**existing_data, **self.new_vacancies}
         self._save_data("Vacancy.json", updated_data)
+        self.seen_ids.clear_expired()
+        self.seen_ids.add(self.new_vacancies)
         return True
 
 
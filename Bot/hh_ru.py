@@ -1,5 +1,8 @@
-from typing import Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional
 import logging
+import re
+import threading
 import time
 
 import numpy as np
@@ -7,6 +10,8 @@ import requests
 import pandas as pd
 from functools import lru_cache
 
+from seen_ids import SeenIds
+
 
 logger = logging.getLogger(__name__)
 
@@ -14,6 +19,27 @@ logger = logging.getLogger(__name__)
 _city_cache: Dict[str, tuple] = {}
 CACHE_TTL = 3600  # 1 час
 
+# Кэш подробностей вакансий: id -> (данные, время получения)
+_details_cache: Dict[str, tuple] = {}
+_details_cache_lock = threading.Lock()
+DETAILS_CACHE_TTL = 6 * 3600  # 6 часов
+DETAILS_CACHE_MAX_SIZE = 1000
+DETAILS_MAX_WORKERS = 4
+
+EXCEL_PATH = 'Vacancies.xlsx'
+_seen_ids: Optional[SeenIds] = None
+
+
+def get_seen_ids() -> SeenIds:
+    """Индекс id вакансий, уже сохранённых в Excel"""
+    global _seen_ids
+    if _seen_ids is None:
+        _seen_ids = SeenIds(
+            "Vacancies.seen.npz",
+            bootstrap=lambda: pd.read_excel(EXCEL_PATH, usecols=['vacancy_id'])['vacancy_id'],
+        )
+    return _seen_ids
+
 
 def get_search_city_id(city: str) -> Optional[Dict]:
     """Получает ID города с кэшированием"""
@@ -67,6 +93,82 @@ def get_requests(city: str = 'Москва', page: int = 0, per_page: int = 10,
         raise
 
 
+def _cache_vacancy_details(vacancy_id: str, data: Dict, current_time: float) -> None:
+    """Кладёт описание в кэш, удаляя устаревшие и самые старые записи"""
+    with _details_cache_lock:
+        expired = [
+            cached_id for cached_id, (_, cached_time) in _details_cache.items()
+            if current_time - cached_time >= DETAILS_CACHE_TTL
+        ]
+        for cached_id in expired:
+            del _details_cache[cached_id]
+
+        _details_cache.pop(vacancy_id, None)
+        _details_cache[vacancy_id] = (data, current_time)
+
+        # Словарь упорядочен по времени записи - первыми идут самые старые
+        while len(_details_cache) > DETAILS_CACHE_MAX_SIZE:
+            del _details_cache[next(iter(_details_cache))]
+
+
+def get_vacancy_details(vacancy_id: str) -> Optional[Dict]:
+    """Получает полное описание вакансии с кэшированием"""
+    current_time = time.time()
+
+    # Читаем один раз под блокировкой: другой поток может вытеснить запись
+    with _details_cache_lock:
+        cached_data, cached_time = _details_cache.get(vacancy_id, (None, 0))
+    if cached_data is not None and current_time - cached_time < DETAILS_CACHE_TTL:
+        return cached_data
+
+    try:
+        r = requests.get(f"https://api.hh.ru/vacancies/{vacancy_id}", timeout=10)
+        if r.status_code == 200:
+            data = r.json()
+            _cache_vacancy_details(vacancy_id, data, current_time)
+            return data
+        logger.error(f"API error for vacancy {vacancy_id}: {r.status_code}")
+    except Exception as e:
+        logger.error(f"Error fetching vacancy {vacancy_id}: {e}")
+
+    # Возвращаем старое значение из кэша, если есть
+    return cached_data
+
+
+def parse_vacancy_details(content: Dict) -> Dict:
+    """Извлекает из полного описания поля, которых нет в поисковой выдаче"""
+    description = re.sub(r'<[^>]+>', ' ', content.get('description') or '')
+    return {
+        'description': re.sub(r'\s+', ' ', description).strip(),
+        'key_skills': ', '.join(skill['name'] for skill in content.get('key_skills') or []),
+        'contacts': content.get('contacts'),
+    }
+
+
+def enrich_vacancies(vacancies: Dict, vacancy_ids: Iterable, max_workers: int = DETAILS_MAX_WORKERS) -> Dict:
+    """Дополняет выбранные вакансии полным описанием.
+
+    Каждый id запрашивается не более одного раза за вызов,
+    число одновременных запросов ограничено max_workers.
+    """
+    ids = list(dict.fromkeys(vacancy_id for vacancy_id in vacancy_ids if vacancy_id in vacancies))
+    if not ids:
+        return vacancies
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        details = executor.map(get_vacancy_details, (str(vacancy_id) for vacancy_id in ids))
+        for vacancy_id, content in zip(ids, details):
+            if not content:
+                continue
+            extra = parse_vacancy_details(content)
+            if not extra['contacts']:
+                extra['contacts'] = vacancies[vacancy_id].get('contacts')
+            vacancies[vacancy_id].update(extra)
+
+    logger.info(f"Enriched {len(ids)} vacancies with details")
+    return vacancies
+
+
 def parse_vacancy(content: Dict) -> Optional[Dict]:
     """Парсит одну вакансию из API-ответа"""
     try:
@@ -109,11 +211,27 @@ def parse_json(contents: Dict) -> list:
     ]
 
 
+def mark_seen(vacancy_ids: Iterable) -> None:
+    """Отмечает вакансии просмотренными - вызывать после постановки в очередь рассылки"""
+    get_seen_ids().add(vacancy_ids)
+
+
 def update_vacancy(new_df: pd.DataFrame) -> Dict:
-    """Обновляет вакансии и возвращает новые в виде словаря"""
-    EXCEL_PATH = 'Vacancies.xlsx'
+    """Обновляет вакансии и возвращает новые в виде словаря.
 
+    Просмотренными вакансии не отмечаются, для этого есть mark_seen.
+    """
     try:
+        # Приводим индексы к числовому типу
+        new_df.index = pd.to_numeric(new_df.index, errors='coerce')
+
+        # Находим новые вакансии по индексу, не читая Excel
+        seen_ids = get_seen_ids()
+        missing_indexes = pd.Index(seen_ids.filter_new(new_df.index.unique()))
+
+        if missing_indexes.empty:
+            return {}
+
         # Загружаем старые вакансии
         try:
             old_df = pd.read_excel(EXCEL_PATH)
@@ -121,25 +239,24 @@ def update_vacancy(new_df: pd.DataFrame) -> Dict:
         except FileNotFoundError:
             old_df = pd.DataFrame()
 
-        # Приводим индексы к числовому типу
-        new_df.index = pd.to_numeric(new_df.index, errors='coerce')
+        # Отбрасываем вакансии, вышедшие за срок хранения
+        seen_ids.maybe_compact()
         if not old_df.empty:
             old_df.index = pd.to_numeric(old_df.index, errors='coerce')
+            old_df = old_df[~seen_ids.expired_mask(old_df.index)]
 
-        # Находим новые вакансии
-        old_index = old_df.index if not old_df.empty else pd.Index([])
-        missing_indexes = new_df.index.difference(old_index)
-
-        if missing_indexes.empty:
-            return {}
-
-        # Обновляем Excel
-        updated_df = pd.concat([old_df, new_df], axis=0)
+        # Обновляем Excel; строки, записанные до сбоя, заменяются новыми
+        new_rows = new_df.loc[missing_indexes]
+        new_rows = new_rows[~new_rows.index.duplicated()]
+        if not old_df.empty:
+            old_df = old_df[~old_df.index.isin(new_rows.index)]
+        updated_df = pd.concat([old_df, new_rows], axis=0)
         updated_df.dropna(axis=0, how='all', inplace=True)
         updated_df.to_excel(EXCEL_PATH)
+        seen_ids.clear_expired()
 
         # Возвращаем новые вакансии
-        return new_df.loc[missing_indexes].to_dict('index')
+        return new_rows.to_dict('index')
 
     except Exception as e:
         logger.error(f"Error in update_vacancy: {e}", exc_info=True)
@@ -157,7 +274,8 @@ def get_all_vacancies(max_pages=30, per_page=50):
     if vacancies:
         df = pd.DataFrame(vacancies)
         df.set_index('vacancy_id', inplace=True)
-        df.to_excel("Vacancies.xlsx")
+        df.to_excel(EXCEL_PATH)
+        get_seen_ids().add(df.index)
     return
 
 
@@ -0,0 +1,190 @@
+import logging
+import os
+import time
+from typing import Callable, Iterable, List, Optional
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+SEEN_TTL = 30 * 24 * 3600  # вакансии живут около 30 дней
+COMPACT_INTERVAL = 24 * 3600  # 1 день
+TOUCH_INTERVAL = 3600  # точность last_seen, чаще индекс на диск не пишется
+
+
+def _to_int(vacancy_id) -> Optional[int]:
+    """Приводит id вакансии к целому числу"""
+    try:
+        return int(vacancy_id)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+class SeenIds:
+    """Компактный индекс просмотренных вакансий.
+
+    Хранит в памяти отсортированный массив id и время, когда вакансия
+    последний раз встречалась в выдаче (16 байт на вакансию). Записи,
+    не встречавшиеся дольше ttl, удаляются при компактизации.
+    Удалённые id копятся в expired, пока их не вычистят из основного хранилища.
+    """
+
+    def __init__(self, path: str, ttl: int = SEEN_TTL,
+                 bootstrap: Optional[Callable[[], Iterable]] = None):
+        self.path = path
+        self.ttl = ttl
+        self._ids = np.empty(0, dtype=np.int64)
+        self._last_seen = np.empty(0, dtype=np.int64)
+        self._expired = np.empty(0, dtype=np.int64)
+        self._compacted_at = 0
+        self._load(bootstrap)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, vacancy_id) -> bool:
+        return self._member(self._ids, vacancy_id)
+
+    @staticmethod
+    def _member(ids: np.ndarray, vacancy_id) -> bool:
+        """Двоичный поиск id в отсортированном массиве"""
+        value = _to_int(vacancy_id)
+        if value is None:
+            return False
+        pos = np.searchsorted(ids, value)
+        return pos < len(ids) and ids[pos] == value
+
+    def _load(self, bootstrap: Optional[Callable[[], Iterable]]) -> None:
+        """Загружает индекс с диска или строит его из основного хранилища"""
+        if os.path.exists(self.path):
+            try:
+                with np.load(self.path) as data:
+                    self._ids = data['ids'].astype(np.int64)
+                    # first_seen - имя поля в индексах старого формата
+                    last_seen_key = 'last_seen' if 'last_seen' in data.files else 'first_seen'
+                    self._last_seen = data[last_seen_key].astype(np.int64)
+                    self._compacted_at = int(data['compacted_at'])
+                    if 'expired' in data.files:
+                        self._expired = data['expired'].astype(np.int64)
+                return
+            except Exception as e:
+                logger.error(f"Error loading seen ids index {self.path}: {e}")
+
+        if bootstrap is None:
+            return
+
+        # При ошибке чтения хранилища индекс не сохраняем: пустой индекс
+        # выдал бы все старые вакансии за новые
+        try:
+            ids = list(bootstrap())
+        except FileNotFoundError:
+            ids = []
+        except Exception as e:
+            logger.error(f"Error building seen ids index {self.path}: {e}")
+            raise
+
+        # Когда старые записи встречались последний раз, неизвестно - считаем, что сейчас
+        self.add(ids)
+        logger.info(f"Built seen ids index {self.path}: {len(self)} ids")
+
+    def save(self) -> None:
+        """Атомарно сохраняет индекс на диск"""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as file:
+            np.savez(file, ids=self._ids, last_seen=self._last_seen, expired=self._expired,
+                     compacted_at=np.int64(self._compacted_at))
+        os.replace(tmp_path, self.path)
+
+    def is_expired(self, vacancy_id) -> bool:
+        """Удалён ли id из индекса по сроку хранения"""
+        return self._member(self._expired, vacancy_id)
+
+    def expired_mask(self, vacancy_ids: Iterable) -> np.ndarray:
+        """Возвращает булев массив: удалён ли каждый id по сроку хранения"""
+        return np.fromiter((self.is_expired(vacancy_id) for vacancy_id in vacancy_ids), dtype=bool)
+
+    def clear_expired(self) -> None:
+        """Забывает удалённые id после очистки основного хранилища"""
+        if len(self._expired):
+            self._expired = np.empty(0, dtype=np.int64)
+            self.save()
+
+    def filter_new(self, vacancy_ids: Iterable, now: Optional[int] = None) -> List:
+        """Оставляет только ещё не встречавшиеся id (в исходном виде).
+
+        Для уже известных id обновляет last_seen: пока вакансия есть
+        в выдаче, она не истекает и не объявляется новой повторно.
+        """
+        new_ids, seen = [], []
+        for vacancy_id in vacancy_ids:
+            if _to_int(vacancy_id) is None:
+                logger.debug(f"Skipping non-numeric vacancy id: {vacancy_id}")
+                continue
+            if vacancy_id in self:
+                seen.append(vacancy_id)
+            else:
+                new_ids.append(vacancy_id)
+        self.touch(seen, now)
+        return new_ids
+
+    def touch(self, vacancy_ids: Iterable, now: Optional[int] = None) -> None:
+        """Обновляет last_seen известных id, сохраняет индекс при изменении"""
+        now = int(now if now is not None else time.time())
+        values = np.fromiter(
+            (value for value in map(_to_int, vacancy_ids) if value is not None),
+            dtype=np.int64,
+        )
+        positions = np.searchsorted(self._ids, values)
+        found = positions < len(self._ids)
+        found[found] = self._ids[positions[found]] == values[found]
+        positions = positions[found]
+
+        # Пишем на диск не чаще раза в TOUCH_INTERVAL для каждой записи
+        stale = positions[self._last_seen[positions] < now - TOUCH_INTERVAL]
+        if len(stale):
+            self._last_seen[stale] = now
+            self.save()
+
+    def add(self, vacancy_ids: Iterable, now: Optional[int] = None) -> None:
+        """Добавляет id в индекс и сохраняет его"""
+        now = int(now if now is not None else time.time())
+        values = np.unique(np.fromiter(
+            (value for value in map(_to_int, vacancy_ids) if value is not None),
+            dtype=np.int64,
+        ))
+        values = values[~np.isin(values, self._ids, assume_unique=True)]
+
+        if len(values):
+            ids = np.concatenate([self._ids, values])
+            last_seen = np.concatenate([self._last_seen, np.full(len(values), now, dtype=np.int64)])
+            order = np.argsort(ids, kind='stable')
+            self._ids = ids[order]
+            self._last_seen = last_seen[order]
+            # Вернувшаяся вакансия больше не считается удалённой
+            self._expired = np.setdiff1d(self._expired, values, assume_unique=True)
+
+        self.maybe_compact(now)
+        self.save()
+
+    def compact(self, now: Optional[int] = None) -> int:
+        """Удаляет записи, не встречавшиеся дольше ttl, возвращает число удалённых"""
+        now = int(now if now is not None else time.time())
+        keep = self._last_seen >= now - self.ttl
+        removed = int(len(keep) - keep.sum())
+
+        self._expired = np.union1d(self._expired, self._ids[~keep])
+        self._ids = self._ids[keep]
+        self._last_seen = self._last_seen[keep]
+        self._compacted_at = now
+
+        if removed:
+            logger.info(f"Compacted seen ids index {self.path}: removed {removed}, kept {len(self)}")
+        return removed
+
+    def maybe_compact(self, now: Optional[int] = None) -> int:
+        """Компактизирует индекс не чаще раза в COMPACT_INTERVAL"""
+        now = int(now if now is not None else time.time())
+        if now - self._compacted_at < COMPACT_INTERVAL:
+            return 0
+        return self.compact(now)
@@ -1,13 +1,15 @@
 import asyncio
+import json
 import logging
 import os
 import re
 import sqlite3
-from datetime import datetime
-from typing import Dict, List, Optional
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 import pandas as pd
 from aiogram import Bot, Dispatcher
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 from aiogram.filters import Command, CommandStart
 from aiogram.types import (InlineKeyboardButton, KeyboardButton, Message,
                            ReplyKeyboardMarkup, InlineKeyboardMarkup)
@@ -35,6 +37,13 @@ if not TOKEN:
 bot = Bot(token=TOKEN)
 dp = Dispatcher()
 
+OUTBOX_BATCH_SIZE = 500  # строк в одной транзакции записи
+OUTBOX_DRAIN_LIMIT = 100  # строк в одной выборке из outbox
+MESSAGE_LIMIT = 4096  # максимальная длина сообщения Telegram
+DIGEST_INTERVAL = timedelta(hours=24)
+ENRICH_MAX_PER_CYCLE = 5  # запросов /vacancies/{id} за один проход (в выдаче 10 вакансий)
+OUTBOX_SKIP_FIELDS = ('description', 'key_skills')  # нужны только фильтрам
+
 
 # Инициализация SQLite
 def init_db():
@@ -47,6 +56,37 @@ def init_db():
                 filters TEXT
             )
         ''')
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(subscribers)')}
+        if 'digest' not in columns:
+            conn.execute('ALTER TABLE subscribers ADD COLUMN digest INTEGER NOT NULL DEFAULT 0')
+
+        # Очередь доставки: вакансия попадает сюда до отправки и удаляется после
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                vacancy_id INTEGER NOT NULL,
+                payload TEXT NOT NULL,
+                created_at TIMESTAMP,
+                UNIQUE (user_id, vacancy_id)
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS delivery_cursors (
+                user_id INTEGER PRIMARY KEY,
+                last_outbox_id INTEGER NOT NULL DEFAULT 0,
+                last_sent_at TIMESTAMP
+            )
+        ''')
+        # Вакансии, уже показанные пользователю через /latest, в outbox не попадают
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS direct_deliveries (
+                user_id INTEGER NOT NULL,
+                vacancy_id INTEGER NOT NULL,
+                sent_at TIMESTAMP,
+                PRIMARY KEY (user_id, vacancy_id)
+            )
+        ''')
         conn.commit()
 
 
@@ -58,7 +98,8 @@ def get_main_keyboard() -> ReplyKeyboardMarkup:
         keyboard=[
             [KeyboardButton(text="/help"), KeyboardButton(text="/subscribe")],
             [KeyboardButton(text="/unsubscribe"), KeyboardButton(text="/latest")],
-            [KeyboardButton(text="/set_filters"), KeyboardButton(text="/my_filters")]
+            [KeyboardButton(text="/set_filters"), KeyboardButton(text="/my_filters")],
+            [KeyboardButton(text="/digest")]
         ],
         resize_keyboard=True
     )
@@ -75,42 +116,47 @@ def format_vacancy(vacancies_dict: Dict) -> str:
     if not vacancies_dict:
         return "Новых вакансий не найдено"
 
-    result = []
+    result = [
+        vacancy_str
+        for vacancy_data in vacancies_dict.values()
+        if (vacancy_str := format_single_vacancy(vacancy_data))
+    ]
 
-    for vacancy_data in vacancies_dict.values():
-        try:
-            # Безопасное получение и форматирование зарплаты
-            salary = vacancy_data.get('salary_from')
-
-            if salary is None:
-                cleaned_salary = 'З/п не указана'
-            elif isinstance(salary, (int, float)):
-                # Форматируем числовую зарплату
-                cleaned_salary = f"{int(salary):,} ₽".replace(',', ' ')
-            else:
-                # Обрабатываем строковую зарплату
-                cleaned_salary = re.sub(r'\u202f|\xa0', ' ', str(salary)).strip()
-
-            # Безопасное получение остальных полей
-            employer = str(vacancy_data.get('employer_name', 'Не указано'))
-            position = str(vacancy_data.get('vacancy_name', 'Без названия'))
-            address = str(vacancy_data.get('address', 'Локация не указана'))
-            url = str(vacancy_data.get('vacancy_url', '#'))
-
-            vacancy_str = (
-                f"🏢 {employer}\n"
-                f"🔹 {position}\n"
-                f"💵 {cleaned_salary}\n"
-                f"📍 {address}\n"
-                f"🔗 {url}\n"
-            )
-            result.append(vacancy_str)
+    return "\n".join(result) if result else "Нет вакансий для отображения"
 
-        except Exception as e:
-            logger.error(f"Ошибка форматирования вакансии: {e}")
-            continue
 
-    return "\n".join(result) if result else "Нет вакансий для отображения"
+def format_single_vacancy(vacancy_data: Dict) -> Optional[str]:
+    """Форматирует одну вакансию, при ошибке возвращает None"""
+    try:
+        # Безопасное получение и форматирование зарплаты
+        salary = vacancy_data.get('salary_from')
+
+        if salary is None or pd.isna(salary):
+            cleaned_salary = 'З/п не указана'
+        elif isinstance(salary, (int, float)):
+            # Форматируем числовую зарплату
+            cleaned_salary = f"{int(salary):,} ₽".replace(',', ' ')
+        else:
+            # Обрабатываем строковую зарплату
+            cleaned_salary = re.sub(r'\u202f|\xa0', ' ', str(salary)).strip()
+
+        # Безопасное получение остальных полей
+        employer = str(vacancy_data.get('employer_name', 'Не указано'))
+        position = str(vacancy_data.get('vacancy_name', 'Без названия'))
+        address = str(vacancy_data.get('address', 'Локация не указана'))
+        url = str(vacancy_data.get('vacancy_url', '#'))
+
+        return (
+            f"🏢 {employer}\n"
+            f"🔹 {position}\n"
+            f"💵 {cleaned_salary}\n"
+            f"📍 {address}\n"
+            f"🔗 {url}\n"
+        )
+
+    except Exception as e:
+        logger.error(f"Ошибка форматирования вакансии: {e}")
+        return None
 
 
 def get_user_filters(user_id: int) -> List[str]:
@@ -121,7 +167,7 @@ def get_user_filters(user_id: int) -> List[str]:
             (user_id,)
         )
         result = cursor.fetchone()
-    return [f.strip().lower() for f in result[0].split(',')] if result and result[0] else []
+    return parse_filters(result[0]) if result else []
 
 
 def filter_vacancies(vacancies: Dict, filters: List[str]) -> Dict:
@@ -136,6 +182,236 @@ def filter_vacancies(vacancies: Dict, filters: List[str]) -> Dict:
     return filtered
 
 
+def parse_filters(filters: Optional[str]) -> List[str]:
+    return [f.strip().lower() for f in filters.split(',')] if filters else []
+
+
+def has_truncated_snippet(vacancy_data: Dict) -> bool:
+    """Сниппет поисковой выдачи пуст или обрезан - полное описание может дать совпадение"""
+    for field in ('snippet_requirement', 'snippet_responsibility'):
+        snippet = str(vacancy_data.get(field) or '').strip()
+        if not snippet or snippet.endswith(('...', '…')):
+            return True
+    return False
+
+
+def get_enrichment_candidates(vacancies: Dict, filters_lists: List[List[str]],
+                              limit: int = ENRICH_MAX_PER_CYCLE) -> List:
+    """Вакансии, которые не прошли фильтр, но могут пройти по полному описанию.
+
+    Берутся только вакансии с пустым или обрезанным сниппетом. Первыми идут
+    отсеянные фильтрами большего числа подписчиков, при равенстве -
+    стоящие выше в выдаче (она отсортирована по релевантности). Не больше limit штук.
+    """
+    misses: Dict = {}
+    for filters in filters_lists:
+        if not filters:
+            continue
+        matched = filter_vacancies(vacancies, filters)
+        for vacancy_id, vacancy_data in vacancies.items():
+            if vacancy_id in matched or 'description' in vacancy_data:
+                continue
+            if has_truncated_snippet(vacancy_data):
+                misses[vacancy_id] = misses.get(vacancy_id, 0) + 1
+
+    position = {vacancy_id: i for i, vacancy_id in enumerate(vacancies)}
+    return sorted(misses, key=lambda vacancy_id: (-misses[vacancy_id], position[vacancy_id]))[:limit]
+
+
+async def enrich_for_filters(vacancies: Dict, filters_lists: List[List[str]]) -> Dict:
+    """Догружает полное описание только для вакансий, которые оно может провести через фильтры"""
+    candidates = get_enrichment_candidates(vacancies, filters_lists)
+    if not candidates:
+        return vacancies
+
+    try:
+        return await asyncio.to_thread(hh_ru.enrich_vacancies, vacancies, candidates)
+    except Exception as e:
+        logger.error(f"Error enriching vacancies: {e}")
+        return vacancies
+
+
+def enqueue_deliveries(deliveries: Iterable[Tuple[int, int, Dict]]) -> int:
+    """Записывает доставки (user_id, vacancy_id, данные) в outbox пачками"""
+    rows = []
+    for user_id, vacancy_id, vacancy_data in deliveries:
+        payload = {key: value for key, value in vacancy_data.items() if key not in OUTBOX_SKIP_FIELDS}
+        rows.append((
+            user_id, int(vacancy_id), json.dumps(payload, ensure_ascii=False, default=str), datetime.now(),
+            user_id, int(vacancy_id)
+        ))
+
+    with sqlite3.connect('vacancy_bot.db') as conn:
+        for start in range(0, len(rows), OUTBOX_BATCH_SIZE):
+            with conn:
+                conn.executemany(
+                    'INSERT OR IGNORE INTO outbox (user_id, vacancy_id, payload, created_at) '
+                    'SELECT ?, ?, ?, ? WHERE NOT EXISTS ('
+                    'SELECT 1 FROM direct_deliveries WHERE user_id = ? AND vacancy_id = ?)',
+                    rows[start:start + OUTBOX_BATCH_SIZE]
+                )
+    return len(rows)
+
+
+def record_direct_deliveries(user_id: int, vacancy_ids: Iterable) -> None:
+    """Запоминает вакансии, отправленные пользователю напрямую через /latest"""
+    now = datetime.now()
+    with sqlite3.connect('vacancy_bot.db') as conn:
+        conn.executemany(
+            'INSERT OR IGNORE INTO direct_deliveries (user_id, vacancy_id, sent_at) VALUES (?, ?, ?)',
+            [(user_id, int(vacancy_id), now) for vacancy_id in vacancy_ids]
+        )
+        conn.commit()
+
+
+def get_direct_deliveries(user_id: int) -> set:
+    with sqlite3.connect('vacancy_bot.db') as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT vacancy_id FROM direct_deliveries WHERE user_id = ?', (user_id,))
+        return {vacancy_id for vacancy_id, in cursor.fetchall()}
+
+
+def forget_direct_deliveries(vacancy_ids: Iterable) -> None:
+    """Удаляет отметки для вакансий, которые уже отмечены просмотренными"""
+    with sqlite3.connect('vacancy_bot.db') as conn:
+        conn.executemany(
+            'DELETE FROM direct_deliveries WHERE vacancy_id = ?',
+            [(int(vacancy_id),) for vacancy_id in vacancy_ids]
+        )
+        conn.commit()
+
+
+def remove_subscriber(user_id: int) -> int:
+    """Удаляет подписчика вместе с его очередью доставки"""
+    with sqlite3.connect('vacancy_bot.db') as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM subscribers WHERE user_id = ?', (user_id,))
+        removed = cursor.rowcount
+        conn.execute('DELETE FROM outbox WHERE user_id = ?', (user_id,))
+        conn.execute('DELETE FROM delivery_cursors WHERE user_id = ?', (user_id,))
+        conn.execute('DELETE FROM direct_deliveries WHERE user_id = ?', (user_id,))
+        conn.commit()
+    return removed
+
+
+def get_pending_deliveries(user_id: int, cursor_id: int) -> List[Tuple[int, int, Dict]]:
+    with sqlite3.connect('vacancy_bot.db') as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT id, vacancy_id, payload FROM outbox WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?',
+            (user_id, cursor_id, OUTBOX_DRAIN_LIMIT)
+        )
+        return [(row_id, vacancy_id, json.loads(payload)) for row_id, vacancy_id, payload in cursor.fetchall()]
+
+
+def iter_pending_deliveries(user_id: int, cursor_id: int) -> Iterator[Tuple[int, int, Dict]]:
+    """Постранично обходит всю очередь подписчика начиная с курсора"""
+    while rows := get_pending_deliveries(user_id, cursor_id):
+        yield from rows
+        cursor_id = rows[-1][0]
+
+
+def advance_cursor(user_id: int, last_outbox_id: int) -> None:
+    """Сдвигает курсор подписчика и удаляет доставленные строки"""
+    with sqlite3.connect('vacancy_bot.db') as conn:
+        conn.execute(
+            'INSERT INTO delivery_cursors (user_id, last_outbox_id) VALUES (?, ?) '
+            'ON CONFLICT(user_id) DO UPDATE SET last_outbox_id = excluded.last_outbox_id',
+            (user_id, last_outbox_id)
+        )
+        conn.execute('DELETE FROM outbox WHERE user_id = ? AND id <= ?', (user_id, last_outbox_id))
+        conn.commit()
+
+
+def mark_sent(user_id: int) -> None:
+    """Запоминает время последней рассылки подписчику"""
+    with sqlite3.connect('vacancy_bot.db') as conn:
+        conn.execute(
+            'INSERT INTO delivery_cursors (user_id, last_sent_at) VALUES (?, ?) '
+            'ON CONFLICT(user_id) DO UPDATE SET last_sent_at = excluded.last_sent_at',
+            (user_id, datetime.now())
+        )
+        conn.commit()
+
+
+def pack_messages(rows: Iterable[Tuple[int, int, Dict]], header: str) -> Iterator[Tuple[int, Optional[str]]]:
+    """
+    Собирает вакансии в сообщения не длиннее MESSAGE_LIMIT
+
+    :param rows: Строки outbox в формате (id, vacancy_id, vacancy_data)
+    :param header: Заголовок первого сообщения
+    :return: Пары (id последней строки в сообщении, текст или None, если
+             ни одну вакансию не удалось отформатировать)
+    """
+    text, last_id, has_content = header, None, False
+
+    for row_id, _, vacancy_data in rows:
+        vacancy_str = format_single_vacancy(vacancy_data)
+        if vacancy_str:
+            vacancy_str = vacancy_str[:MESSAGE_LIMIT - len(header) - 1]
+            if has_content and len(text) + len(vacancy_str) + 1 > MESSAGE_LIMIT:
+                yield last_id, text
+                text, has_content = '', False
+            text += vacancy_str + "\n"
+            has_content = True
+        last_id = row_id
+
+    if last_id is not None:
+        yield last_id, text if has_content else None
+
+
+async def send_pending(user_id: int, cursor_id: int, digest: bool) -> None:
+    """
+    Отправляет подписчику всю накопленную очередь минимальным числом сообщений.
+
+    Постоянные ошибки Telegram не блокируют очередь: заблокировавший бота
+    пользователь удаляется, отклонённое сообщение пропускается. Остальные
+    ошибки пробрасываются, и очередь повторяется со следующего прохода.
+    """
+    header = "📬 Дайджест вакансий:\n" if digest else "Новые вакансии:\n"
+
+    for last_id, text in pack_messages(iter_pending_deliveries(user_id, cursor_id), header):
+        if text:
+            try:
+                await bot.send_message(user_id, text)
+            except TelegramForbiddenError:
+                logger.warning(f"User {user_id} blocked the bot, removing subscriber")
+                remove_subscriber(user_id)
+                return
+            except TelegramBadRequest as e:
+                logger.error(f"Message to user {user_id} rejected, skipping: {e}")
+            await asyncio.sleep(0.1)
+        advance_cursor(user_id, last_id)
+
+    # Для дайджеста отсчёт интервала начинается после отправки всей очереди
+    mark_sent(user_id)
+
+
+async def drain_outbox():
+    """Рассылает всё, что осталось в outbox, начиная с курсора каждого подписчика"""
+    with sqlite3.connect('vacancy_bot.db') as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT s.user_id, s.digest, COALESCE(c.last_outbox_id, 0), c.last_sent_at
+            FROM subscribers s
+            LEFT JOIN delivery_cursors c ON c.user_id = s.user_id
+            WHERE EXISTS (
+                SELECT 1 FROM outbox o
+                WHERE o.user_id = s.user_id AND o.id > COALESCE(c.last_outbox_id, 0)
+            )
+        ''')
+        pending_users = cursor.fetchall()
+
+    now = datetime.now()
+    for user_id, digest, cursor_id, last_sent_at in pending_users:
+        if digest and last_sent_at and now - datetime.fromisoformat(str(last_sent_at)) < DIGEST_INTERVAL:
+            continue
+        try:
+            await send_pending(user_id, cursor_id, bool(digest))
+        except Exception as e:
+            logger.error(f"Error sending to user {user_id}: {str(e)}")
+
+
 async def get_new_vacancies(per_page=10, page=0, text=''):
     """Получение только новых вакансий с полной обработкой ошибок"""
     try:
@@ -175,7 +451,8 @@ async def process_help_command(message: Message):
         '/unsubscribe - отписаться от рассылки\n'
         '/latest - получить последние вакансии\n'
         '/set_filters - установить фильтры по ключевым словам\n'
-        '/my_filters - посмотреть текущие фильтры',
+        '/my_filters - посмотреть текущие фильтры\n'
+        '/digest - включить/выключить ежедневный дайджест',
         reply_markup=get_main_keyboard()
     )
 
@@ -187,15 +464,25 @@ async def send_latest_vacancies(message: Message):
 
     try:
         new_vacancies = await get_new_vacancies()
+
+        # Уже показанные этому пользователю вакансии не повторяем
+        already_sent = get_direct_deliveries(user_id)
+        new_vacancies = {
+            vacancy_id: vacancy_data for vacancy_id, vacancy_data in (new_vacancies or {}).items()
+            if int(vacancy_id) not in already_sent
+        }
         if not new_vacancies:
             await message.answer("Новых вакансий не найдено.")
             return
 
         filters = get_user_filters(user_id)
+        new_vacancies = await enrich_for_filters(new_vacancies, [filters])
         filtered_vacancies = filter_vacancies(new_vacancies, filters)
 
         formatted = format_vacancy(filtered_vacancies)
         await message.answer(formatted if formatted else "Нет вакансий по вашему фильтру.")
+        # Просмотренными вакансии отмечает только фоновая проверка
+        record_direct_deliveries(user_id, filtered_vacancies.keys())
 
     except Exception as e:
         logger.error(f"Error getting vacancies for {user_id}: {e}")
@@ -234,12 +521,7 @@ async def subscribe_user(message: Message):
 async def unsubscribe_user(message: Message):
     user_id = message.from_user.id
 
-    with sqlite3.connect('vacancy_bot.db') as conn:
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM subscribers WHERE user_id = ?', (user_id,))
-        conn.commit()
-
-    if cursor.rowcount > 0:
+    if remove_subscriber(user_id) > 0:
         await message.answer(
             "Вы отписались от рассылки вакансий.",
             reply_markup=get_main_keyboard()
@@ -249,10 +531,33 @@ async def unsubscribe_user(message: Message):
         await message.answer("Вы не были подписаны на рассылку.")
 
 
+@dp.message(Command(commands='digest'))
+async def toggle_digest(message: Message):
+    user_id = message.from_user.id
+
+    with sqlite3.connect('vacancy_bot.db') as conn:
+        cursor = conn.cursor()
+        cursor.execute('UPDATE subscribers SET digest = 1 - digest WHERE user_id = ?', (user_id,))
+        cursor.execute('SELECT digest FROM subscribers WHERE user_id = ?', (user_id,))
+        result = cursor.fetchone()
+        conn.commit()
+
+    if not result:
+        await message.answer("Сначала подпишитесь на рассылку: /subscribe")
+    elif result[0]:
+        await message.answer("📬 Дайджест включён: вакансии будут приходить одним сообщением раз в сутки.")
+    else:
+        await message.answer("Дайджест выключен: вакансии будут приходить по мере появления.")
+    logger.info(f"User {user_id} toggled digest mode")
+
+
 async def check_new_vacancies():
     """Периодически проверяет новые вакансии и рассылает подписчикам"""
     while True:
         try:
+            # Досылаем то, что не успели отправить до перезапуска
+            await drain_outbox()
+
             logger.info("Checking for new vacancies...")
             new_vacancies = await get_new_vacancies()
 
@@ -263,21 +568,25 @@ async def check_new_vacancies():
             with sqlite3.connect('vacancy_bot.db') as conn:
                 cursor = conn.cursor()
                 cursor.execute('SELECT user_id, filters FROM subscribers')
-                subscribers = cursor.fetchall()
-
-            for user_id, filters in subscribers:
-                try:
-                    filters_list = [f.strip().lower() for f in filters.split(',')] if filters else []
-                    filtered = filter_vacancies(new_vacancies, filters_list)
-
-                    if filtered:
-                        await bot.send_message(
-                            user_id,
-                            "Новые вакансии:\n" + format_vacancy(filtered)
-                        )
-                        await asyncio.sleep(0.1)
-                except Exception as e:
-                    logger.error(f"Error sending to user {user_id}: {str(e)}")
+                subscribers = [(user_id, parse_filters(filters)) for user_id, filters in cursor.fetchall()]
+
+            new_vacancies = await enrich_for_filters(
+                new_vacancies, [filters_list for _, filters_list in subscribers]
+            )
+
+            deliveries = [
+                (user_id, vacancy_id, vacancy_data)
+                for user_id, filters_list in subscribers
+                for vacancy_id, vacancy_data in filter_vacancies(new_vacancies, filters_list).items()
+            ]
+            enqueue_deliveries(deliveries)
+            logger.info(f"Queued {len(deliveries)} deliveries")
+
+            # Только после записи в outbox: сбой до этого места повторит проверку
+            hh_ru.mark_seen(new_vacancies.keys())
+            forget_direct_deliveries(new_vacancies.keys())
+
+            await drain_outbox()
 
             await asyncio.sleep(60 * 30)
 